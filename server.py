@@ -5,16 +5,67 @@ eventlet.monkey_patch()
 
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
-import random
-import threading
+from random import shuffle
+from collections import deque
+import os
+import orjson
+
+class OrjsonCodec:
+    # json-module stand-in for Socket.IO packet encoding, backed by orjson.
+    # Socket.IO passes separators= to dumps; orjson output is already compact.
+    # Unlike stdlib json it rejects non-str dict keys and ints beyond 64 bits,
+    # so handlers validate client input before it can reach a payload.
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
+# Game rooms live in this process's memory, so the server runs as a single
+# process
+socketio = SocketIO(app, async_mode='eventlet', json=OrjsonCodec)
+_server = socketio.server  # Underlying python-socketio server, used for room emits
 
 rooms = {}  # Stores game room data
 sid_to_user = {}  # Maps session IDs to user data
 
+class Player:
+    # Per-player game state; slots keep each instance small and attribute access cheap
+    __slots__ = ('board', 'marked', 'bingo', 'submitted')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.board = ()  # Tuple of 25 ints once submitted
+        self.marked = 0  # Bitmask of marked cells
+        self.bingo = False
+        self.submitted = False
+
+# Rows, columns and diagonals of the 5x5 board, as cell indices
+BINGO_LINES = (
+    (0,1,2,3,4),
+    (5,6,7,8,9),
+    (10,11,12,13,14),
+    (15,16,17,18,19),
+    (20,21,22,23,24),
+    (0,5,10,15,20),
+    (1,6,11,16,21),
+    (2,7,12,17,22),
+    (3,8,13,18,23),
+    (4,9,14,19,24),
+    (0,6,12,18,24),
+    (4,8,12,16,20)
+)
+# Same lines as bitmasks over a player's marked cells
+LINE_MASKS = tuple(sum(1 << i for i in line) for line in BINGO_LINES)
+# For each cell, only the line masks that pass through it
+CELL_LINE_MASKS = tuple(tuple(mask for mask in LINE_MASKS if mask >> i & 1) for i in range(25))
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -23,27 +74,33 @@ def index():
 def on_create_room(data):
     room = data['room']
     username = data['username']
+    # Both end up as str dict keys in broadcast payloads
+    if type(room) is not str or type(username) is not str:
+        emit('error', {'message': '房間或名稱格式錯誤'})
+        return
     sid = request.sid
     join_room(room)
-    sid_to_user[sid] = {'username': username, 'room': room}
+    sid_to_user[sid] = {'username': username, 'room': room, 'emit': room_emitter(room)}
     if room not in rooms:
         rooms[room] = {
             'players': {},
             'numbers_called': [],
+            'numbers_called_set': set(),
+            'number_owners': {},
             'chat': [],
             'game_started': False,
-            'turn_order': [],
-            'current_turn': 0,
+            'turn_order': deque(),  # Current player is always turn_order[0]
             'timer': None,
             'start_votes': set(),
-            'waiting_for_players': True
+            'waiting_for_players': True,
+            # Payload dicts reused by every broadcast of these events
+            '_ncpayload': {'number': 0, 'winner': None, 'username': ''},
+            '_subpayload': {'submission_status': {}},
+            '_sub_pending': False,
+            '_names': ()  # Cached player names, refreshed on membership change
         }
-    rooms[room]['players'][username] = {
-        'board': [],
-        'marked': [],
-        'bingo': False,
-        'submitted': False
-    }
+    rooms[room]['players'][username] = Player()
+    rooms[room]['_names'] = tuple(rooms[room]['players'])
     emit('room_created', {'room': room})
     update_player_list(room)
 
@@ -51,18 +108,18 @@ def on_create_room(data):
 def on_join_room(data):
     room = data['room']
     username = data['username']
+    # Both end up as str dict keys in broadcast payloads
+    if type(room) is not str or type(username) is not str:
+        emit('error', {'message': '房間或名稱格式錯誤'})
+        return
     sid = request.sid
     join_room(room)
-    sid_to_user[sid] = {'username': username, 'room': room}
+    sid_to_user[sid] = {'username': username, 'room': room, 'emit': room_emitter(room)}
     if room not in rooms:
         emit('error', {'message': '房間不存在'})
         return
-    rooms[room]['players'][username] = {
-        'board': [],
-        'marked': [],
-        'bingo': False,
-        'submitted': False
-    }
+    rooms[room]['players'][username] = Player()
+    rooms[room]['_names'] = tuple(rooms[room]['players'])
     emit('player_joined', {'username': username}, room=room)
     update_player_list(room)
 
@@ -78,25 +135,42 @@ def on_disconnect():
         if room in rooms and username in rooms[room]['players']:
             del rooms[room]['players'][username]
             if len(rooms[room]['players']) == 0:
+                if rooms[room]['timer'] is not None:
+                    rooms[room]['timer'].cancel()
                 del rooms[room]
             else:
+                rooms[room]['_names'] = tuple(rooms[room]['players'])
                 update_player_list(room)
                 if rooms[room]['game_started']:
-                    if username in rooms[room]['turn_order']:
-                        idx = rooms[room]['turn_order'].index(username)
-                        del rooms[room]['turn_order'][idx]
-                        if idx <= rooms[room]['current_turn']:
-                            rooms[room]['current_turn'] -= 1
-                    if len(rooms[room]['turn_order']) < 2:
+                    build_number_index(room)
+                    turn_order = rooms[room]['turn_order']
+                    was_current = bool(turn_order) and turn_order[0] == username
+                    try:
+                        turn_order.remove(username)
+                    except ValueError:
+                        pass
+                    if len(turn_order) < 2:
                         # End game if less than two players
                         rooms[room]['game_started'] = False
+                        if rooms[room]['timer'] is not None:
+                            rooms[room]['timer'].cancel()
+                            rooms[room]['timer'] = None
                         emit('game_ended', {'message': '遊戲因玩家離開而結束'}, room=room)
                     else:
                         emit('player_left', {'username': username}, room=room)
+                        if was_current:
+                            # The next player is now at the front; give them a full turn
+                            start_turn_timer(room)
+
+def room_emitter(room):
+    # Bound emit to a single room, cached per connection so hot handlers skip
+    # flask_socketio's request-context lookup
+    def room_emit(event, data):
+        _server.emit(event, data, to=room, namespace='/')
+    return room_emit
 
 def update_player_list(room):
-    players = list(rooms[room]['players'].keys())
-    emit('update_player_list', {'players': players}, room=room)
+    emit('update_player_list', {'players': rooms[room]['_names']}, room=room)
 
 @socketio.on('submit_board')
 def on_submit_board(data):
@@ -106,14 +180,41 @@ def on_submit_board(data):
         return
     room = user['room']
     username = user['username']
-    board = data['board']  # List of 25 numbers
-    rooms[room]['players'][username]['board'] = board
-    rooms[room]['players'][username]['marked'] = [False]*25
-    rooms[room]['players'][username]['submitted'] = True
-    emit('board_submitted', {'username': username}, room=room)
-    # Send updated submission status to all players
-    submission_status = {uname: player['submitted'] for uname, player in rooms[room]['players'].items()}
-    emit('update_submission_status', {'submission_status': submission_status}, room=room)
+    # The number index is built from the boards at game start, so boards are
+    # fixed until the game ends
+    if rooms[room]['game_started']:
+        emit('error', {'message': '遊戲進行中，無法更換板子'})
+        return
+    # The board must be 25 distinct ints from the 1-25 number pool; bools,
+    # floats and strings are rejected rather than coerced
+    board = data.get('board') if isinstance(data, dict) else None
+    if (type(board) is not list or len(board) != 25
+            or any(type(n) is not int or not 1 <= n <= 25 for n in board)
+            or len(set(board)) != 25):
+        emit('error', {'message': '板子格式錯誤'})
+        return
+    board = tuple(board)
+    player = rooms[room]['players'][username]
+    player.board = board
+    player.marked = 0
+    player.submitted = True
+    user['emit']('board_submitted', {'username': username})
+    # Send updated submission status to all players, coalescing bursts of
+    # submissions into a single broadcast
+    if not rooms[room]['_sub_pending']:
+        rooms[room]['_sub_pending'] = True
+        eventlet.spawn_after(0.05, _flush_submission, room)
+
+def _flush_submission(room):
+    if room not in rooms:
+        return
+    rooms[room]['_sub_pending'] = False
+    payload = rooms[room]['_subpayload']
+    submission_status = payload['submission_status']
+    submission_status.clear()
+    for uname, player in rooms[room]['players'].items():
+        submission_status[uname] = player.submitted
+    socketio.emit('update_submission_status', payload, room=room)
 
 @socketio.on('start_game')
 def on_start_game():
@@ -126,41 +227,50 @@ def on_start_game():
     rooms[room]['start_votes'].add(username)
     # Check if game can start
     if len(rooms[room]['players']) >= 2 and len(rooms[room]['start_votes']) >= 2:
-        all_submitted = all(p['submitted'] for p in rooms[room]['players'].values())
+        all_submitted = all(p.submitted for p in rooms[room]['players'].values())
         if all_submitted:
             rooms[room]['game_started'] = True
             rooms[room]['waiting_for_players'] = False
             # Randomize turn order
-            rooms[room]['turn_order'] = list(rooms[room]['players'].keys())
-            random.shuffle(rooms[room]['turn_order'])
-            rooms[room]['current_turn'] = 0
-            emit('game_started', {'turn_order': rooms[room]['turn_order']}, room=room)
+            turn_order = list(rooms[room]['players'].keys())
+            shuffle(turn_order)
+            rooms[room]['turn_order'] = deque(turn_order)
+            build_number_index(room)
+            emit('game_started', {'turn_order': turn_order}, room=room)
             start_turn_timer(room)
         else:
             emit('waiting_for_players', {'message': '等待其他玩家提交板'}, room=room)
     else:
         emit('waiting_for_players', {'message': '需要至少兩名玩家開始遊戲'}, room=room)
 
+def build_number_index(room):
+    # Map each number to (username, player, cell bit, line masks through that
+    # cell) for every board holding it, so a call is a few integer ops per hit
+    number_owners = {}
+    for uname, player in rooms[room]['players'].items():
+        for i, n in enumerate(player.board):
+            number_owners.setdefault(n, []).append((uname, player, 1 << i, CELL_LINE_MASKS[i]))
+    rooms[room]['number_owners'] = number_owners
+
 def start_turn_timer(room):
-    # Cancel previous timer
-    if rooms[room]['timer']:
+    # Cancel previous timer. A pending GreenThread is falsy until it runs,
+    # so test against None rather than truthiness
+    if rooms[room]['timer'] is not None:
         rooms[room]['timer'].cancel()
-    # Start new timer
-    timer = threading.Timer(15, skip_turn, args=[room])
-    rooms[room]['timer'] = timer
-    timer.start()
+    # Start new timer on the eventlet hub instead of an OS thread
+    rooms[room]['timer'] = eventlet.spawn_after(15, skip_turn, room)
     # Notify all players whose turn it is
-    current_player = rooms[room]['turn_order'][rooms[room]['current_turn']]
-    emit('your_turn', {'username': current_player}, room=room)
+    current_player = rooms[room]['turn_order'][0]
+    socketio.emit('your_turn', {'username': current_player}, room=room)
 
 def skip_turn(room):
-    # Handle player timeout
-    current_player = rooms[room]['turn_order'][rooms[room]['current_turn']]
-    emit('turn_skipped', {'username': current_player}, room=room)
+    # Handle player timeout (runs from the timer, outside any request context)
+    current_player = rooms[room]['turn_order'][0]
+    socketio.emit('turn_skipped', {'username': current_player}, room=room)
     advance_turn(room)
 
 def advance_turn(room):
-    rooms[room]['current_turn'] = (rooms[room]['current_turn'] + 1) % len(rooms[room]['turn_order'])
+    rooms[room]['turn_order'].rotate(-1)
     start_turn_timer(room)
 
 @socketio.on('number_selected')
@@ -172,44 +282,60 @@ def on_number_selected(data):
     room = user['room']
     username = user['username']
     number = data['number']
+    # Only numbers from the 1-25 pool can be on a board; reject anything else
+    # before it reaches numbers_called
+    if type(number) is not int or not 1 <= number <= 25:
+        emit('error', {'message': '無效的數字'})
+        return
     # Check if it's the player's turn
-    current_player = rooms[room]['turn_order'][rooms[room]['current_turn']]
+    current_player = rooms[room]['turn_order'][0]
     if username != current_player:
         emit('error', {'message': '不是你的回合'})
         return
     # Check if number has already been called
-    if number in rooms[room]['numbers_called']:
+    if number in rooms[room]['numbers_called_set']:
         emit('error', {'message': '該數字已被選過'})
         return
     rooms[room]['numbers_called'].append(number)
+    rooms[room]['numbers_called_set'].add(number)
     # Update all players' marked numbers
     winner = None
-    for uname, player in rooms[room]['players'].items():
-        if number in player['board']:
-            index = player['board'].index(number)
-            player['marked'][index] = True
-            # Check for BINGO
-            if check_bingo(player['marked']):
-                player['bingo'] = True
-                winner = uname
-    emit('number_called', {
-        'number': number,
-        'winner': winner,
-        'username': username,
-        'numbers_called': rooms[room]['numbers_called']
-    }, room=room)
+    for uname, player, bit, line_masks in rooms[room]['number_owners'].get(number, ()):
+        player.marked |= bit
+        # Check for BINGO, only on the lines through the newly marked cell
+        if check_bingo(player.marked, line_masks):
+            player.bingo = True
+            winner = uname
+    payload = rooms[room]['_ncpayload']
+    payload['number'] = number
+    payload['winner'] = winner
+    payload['username'] = username
+    user['emit']('number_called', payload)
     if winner:
         rooms[room]['game_started'] = False
-        if rooms[room]['timer']:
+        if rooms[room]['timer'] is not None:
             rooms[room]['timer'].cancel()
-        emit('game_over', {'winner': winner}, room=room)
+            rooms[room]['timer'] = None
+        user['emit']('game_over', {'winner': winner})
     else:
         advance_turn(room)
 
+@socketio.on('sync_state')
+def on_sync_state():
+    # number_called only carries the new number, so clients fetch the full
+    # list through this event's ack once they are in a room
+    sid = request.sid
+    user = sid_to_user.get(sid)
+    if not user or user['room'] not in rooms:
+        return {'numbers_called': []}
+    return {'numbers_called': rooms[user['room']]['numbers_called']}
+
 @socketio.on('send_message')
 def on_send_message(data):
     sid = request.sid
     message = data['message']
+    if type(message) is not str:
+        return
     user = sid_to_user.get(sid)
     if user:
         username = user['username']
@@ -234,42 +360,26 @@ def on_restart_game():
         return
     # Reset game state
     rooms[room]['game_started'] = False
+    if rooms[room]['timer'] is not None:
+        rooms[room]['timer'].cancel()
+        rooms[room]['timer'] = None
     rooms[room]['numbers_called'] = []
-    rooms[room]['turn_order'] = []
-    rooms[room]['current_turn'] = 0
+    rooms[room]['numbers_called_set'] = set()
+    rooms[room]['number_owners'] = {}
+    rooms[room]['turn_order'] = deque()
     rooms[room]['start_votes'] = set()
     rooms[room]['waiting_for_players'] = True
     for player in rooms[room]['players'].values():
-        player['board'] = []
-        player['marked'] = []
-        player['bingo'] = False
-        player['submitted'] = False
+        player.reset()
     # Notify all players to reset their boards
     emit('restart_game', room=room)
 
-def check_bingo(marked):
-    lines = [
-        [0,1,2,3,4],
-        [5,6,7,8,9],
-        [10,11,12,13,14],
-        [15,16,17,18,19],
-        [20,21,22,23,24],
-        [0,5,10,15,20],
-        [1,6,11,16,21],
-        [2,7,12,17,22],
-        [3,8,13,18,23],
-        [4,9,14,19,24],
-        [0,6,12,18,24],
-        [4,8,12,16,20]
-    ]
-    for line in lines:
-        if all([marked[i] for i in line]):
-            return True
-    return False
+def check_bingo(marked, _masks=LINE_MASKS):
+    # marked is a bitmask: bit i is set when cell i has been called.
+    # _masks defaults to every line (bound as a local, not a global lookup);
+    # callers that know which cell changed pass just the lines through it
+    return any((marked & mask) == mask for mask in _masks)
 
-# if __name__ == '__main__':
-#     socketio.run(app, debug=True)
 if __name__ == '__main__':
-    import os
     port = int(os.environ.get('PORT', 5000))
     socketio.run(app, host='0.0.0.0', port=port)
\ No newline at end of file